@@ -14,7 +14,12 @@
 #
 # Author: Gris Ge <fge@redhat.com>
 
+import collections
+import functools
 import os
+import time
+import weakref
+from multiprocessing.pool import ThreadPool
 
 from lsm import (uri_parse, search_property, LsmError, ErrorNumber, Client,
                  VERSION, IPlugin, NfsExport)
@@ -22,8 +27,14 @@
 from hpsa_plugin import SmartArray
 from arcconf_plugin import Arcconf
 
+_URI_TRUE_VALUES = frozenset(("true", "yes", "on", "1"))
+
+_NFS_NOT_LOADED_ERR_MSG = ("NFS plugin is not loaded, please load nfsd kernel "
+                           "module and related services")
+
 
 def _handle_errors(method):
+    @functools.wraps(method)
     def _wrapper(*args, **kwargs):
         try:
             return method(*args, **kwargs)
@@ -43,18 +54,43 @@ class LocalPlugin(IPlugin):
         "aacraid": "arcconf",
         "nfsd": "nfs",
     }
+    _KMODS = frozenset(_KMOD_PLUGIN_MAP)
+    _SUPPORTED_PLUGINS = frozenset(_KMOD_PLUGIN_MAP.values())
+    # Seconds for which _query() results are reused.
+    _QUERY_CACHE_TTL = 2
 
     def __init__(self):
         self._tmo_ms = 3000
         self.conns = []
         self.syss = []
         self.sys_con_map = {}
-        self.unregistered = False
         self.nfs_conn = None
-
-    def __del__(self):
-        if not self.unregistered:
-            self.plugin_unregister()
+        self._pool = None
+        self._cap_cache = {}
+        self._query_cache = {}
+        self._method_cache = {}
+        self._finalizer = None
+
+    @staticmethod
+    def _cleanup(conns, pool):
+        # Best effort teardown for a plugin dropped without
+        # plugin_unregister(), it must not reference the plugin itself.
+        for conn in conns:
+            try:
+                conn.plugin_unregister()
+            except Exception:
+                pass
+        pool.close()
+        pool.join()
+
+    def _bound(self, conn, func_name):
+        # Resolve a sub-plugin method once and reuse the bound method.
+        key = (id(conn), func_name)
+        method = self._method_cache.get(key)
+        if method is None:
+            method = getattr(conn, func_name)
+            self._method_cache[key] = method
+        return method
 
     def _query(self,
                query_func_name,
@@ -63,52 +99,79 @@ def _query(self,
                flags=Client.FLAG_RSVD):
         lsm_objs = []
         if search_key == "system_id":
-            if search_value not in self.sys_con_map.keys():
+            if search_value not in self.sys_con_map:
                 return []
-            return getattr(self.sys_con_map[search_value],
-                           query_func_name)(flags=flags)
-
-        for conn in self.conns:
+            return self._bound(self.sys_con_map[search_value],
+                               query_func_name)(flags=flags)
+
+        # Tools like lsmcli tend to issue the same query several times in a
+        # row, hence reuse recent results instead of asking every sub-plugin
+        # again.
+        cache_key = (query_func_name, flags)
+        now = time.time()
+        cached = self._query_cache.get(cache_key)
+        if cached is not None:
+            cached_time, cached_objs = cached
+            if 0 <= now - cached_time < LocalPlugin._QUERY_CACHE_TTL:
+                return search_property(list(cached_objs), search_key,
+                                       search_value)
+
+        # No sub-plugin is registered.
+        if self._pool is None:
+            return []
+
+        def _sub_query(conn):
             try:
-                lsm_objs.extend(getattr(conn, query_func_name)(flags=flags))
+                return self._bound(conn, query_func_name)(flags=flags)
             except LsmError as lsm_err:
                 if lsm_err.code == ErrorNumber.NO_SUPPORT:
-                    pass
-                else:
-                    raise
+                    return []
+                raise
+
+        for sub_lsm_objs in self._pool.map(_sub_query, self.conns):
+            lsm_objs.extend(sub_lsm_objs)
+        self._query_cache[cache_key] = (now, list(lsm_objs))
         return search_property(lsm_objs, search_key, search_value)
 
+    def _nfs(self, func_name, *args, **kwargs):
+        if self.nfs_conn is None:
+            raise LsmError(ErrorNumber.NO_SUPPORT, _NFS_NOT_LOADED_ERR_MSG)
+        return getattr(self.nfs_conn, func_name)(*args, **kwargs)
+
     def _exec(self, sys_id, func_name, parameters):
-        if sys_id not in self.sys_con_map.keys():
+        conn = self.sys_con_map.get(sys_id)
+        if conn is None:
             raise LsmError(ErrorNumber.NOT_FOUND_SYSTEM, "System not found")
-        return getattr(self.sys_con_map[sys_id], func_name)(**parameters)
+        return getattr(conn, func_name)(**parameters)
+
+    def _exec_modify(self, sys_id, func_name, parameters):
+        # The call changes the storage layout, drop cached query results.
+        self._query_cache.clear()
+        return self._exec(sys_id, func_name, parameters)
 
     @_handle_errors
     def plugin_register(self, uri, password, timeout, flags=Client.FLAG_RSVD):
         self._tmo_ms = timeout
 
-        supported_plugins = set(LocalPlugin._KMOD_PLUGIN_MAP.values())
         if os.geteuid() != 0:
             raise LsmError(
                 ErrorNumber.INVALID_ARGUMENT,
                 "This plugin requires root privilege both daemon and client")
         uri_parsed = uri_parse(uri)
         uri_vars = uri_parsed.get("parameters", {})
-        ignore_init_error = bool(uri_vars.get("ignore_init_error", "false"))
+        ignore_init_error = uri_vars.get(
+            "ignore_init_error", "").strip().lower() in _URI_TRUE_VALUES
 
-        sub_uri_paras = {}
-        for plugin_name in supported_plugins:
-            sub_uri_paras[plugin_name] = []
-
-        for key in uri_vars.keys():
-            for plugin_name in supported_plugins:
-                if key.startswith("%s_" % plugin_name):
-                    sub_uri_paras[plugin_name].append(
-                        "%s=%s" %
-                        (key[len("%s_" % plugin_name):], uri_vars[key]))
+        # URI parameters named like <plugin_name>_<key> are passed to the
+        # sub-plugin as <key>.
+        sub_uri_paras = collections.defaultdict(list)
+        for key, value in uri_vars.items():
+            plugin_name, sep, sub_key = key.partition("_")
+            if sep and plugin_name in LocalPlugin._SUPPORTED_PLUGINS:
+                sub_uri_paras[plugin_name].append("%s=%s" % (sub_key, value))
 
         only_plugin = uri_vars.get("only", "")
-        if only_plugin and only_plugin not in supported_plugins:
+        if only_plugin and only_plugin not in LocalPlugin._SUPPORTED_PLUGINS:
             raise LsmError(
                 ErrorNumber.INVALID_ARGUMENT,
                 "Plugin defined in only=%s is not supported" % only_plugin)
@@ -116,11 +179,11 @@ def plugin_register(self, uri, password, timeout, flags=Client.FLAG_RSVD):
             requested_plugins = [only_plugin]
         else:
             # Check kernel module to determine which plugin to load
-            requested_plugins = []
-            cur_kmods = os.listdir("/sys/module/")
-            for kmod_name, plugin_name in LocalPlugin._KMOD_PLUGIN_MAP.items():
-                if kmod_name in cur_kmods:
-                    requested_plugins.append(plugin_name)
+            cur_kmods = set(os.listdir("/sys/module/"))
+            requested_plugins = [
+                LocalPlugin._KMOD_PLUGIN_MAP[kmod_name]
+                for kmod_name in LocalPlugin._KMODS & cur_kmods
+            ]
             # smartpqi could be managed both by hpsa and arcconf plugin, hence
             # need extra care here: if arcconf binary tool is installed, we use
             # it, if not, we try hpsa binary tool. If none was installed, we
@@ -141,34 +204,105 @@ def plugin_register(self, uri, password, timeout, flags=Client.FLAG_RSVD):
             raise LsmError(ErrorNumber.NO_SUPPORT,
                            "No supported hardware found")
 
-        for plugin_name in requested_plugins:
+        def _spawn(plugin_name):
             plugin_uri = "%s://" % plugin_name
-            if sub_uri_paras[plugin_name]:
+            if sub_uri_paras.get(plugin_name):
                 plugin_uri += "?%s" % "&".join(sub_uri_paras[plugin_name])
             try:
-                conn = Client(plugin_uri, None, timeout, flags)
                 # So far, no local plugins require password
+                return plugin_name, Client(plugin_uri, None, timeout, flags)
+            except LsmError as lsm_err:
+                return plugin_name, lsm_err
+            except Exception as common_error:
+                # Returned rather than raised so that ThreadPool.map() still
+                # hands back the connections spawned by the other workers.
+                return plugin_name, LsmError(
+                    ErrorNumber.PLUGIN_BUG,
+                    "Got unexpected error %s" % common_error)
+
+        # Each Client() blocks on its own plugin daemon handshake, hence
+        # spawn them concurrently and only handle errors once all are done.
+        # The same thread pool is used for every later request fanned out to
+        # the sub-plugins until plugin_unregister().
+        requested_plugins = list(requested_plugins)
+        if self._pool is not None:
+            # Registering again, release the previous sub-plugins, pool and
+            # finalizer first.
+            self.plugin_unregister()
+        self._pool = ThreadPool(len(requested_plugins))
+        # Unlike __del__(), this does not run RPCs from inside the garbage
+        # collector and still runs at interpreter exit while pool threads are
+        # alive. Python 2 has no weakref.finalize(), there sub-plugins quit
+        # on their own once their connection is closed.
+        if hasattr(weakref, "finalize"):
+            self._finalizer = weakref.finalize(self, LocalPlugin._cleanup,
+                                               self.conns, self._pool)
+        try:
+            init_error = None
+            for plugin_name, conn in self._pool.map(_spawn, requested_plugins):
+                if isinstance(conn, LsmError):
+                    if not ignore_init_error and init_error is None:
+                        init_error = conn
+                    continue
                 self.conns.append(conn)
                 if plugin_name == 'nfs':
                     self.nfs_conn = conn
-            except LsmError as lsm_err:
-                if ignore_init_error:
-                    pass
-                else:
-                    raise lsm_err
-        for conn in self.conns:
-            for sys in conn.systems():
-                self.sys_con_map[sys.id] = conn
-                self.syss.append(sys)
-        if not self.sys_con_map:
-            raise LsmError(ErrorNumber.NO_SUPPORT,
-                           "No supported systems found")
+            if init_error is not None:
+                raise init_error
+
+            sys_lists = self._pool.map(lambda c: c.systems(), self.conns)
+            sys_conn_pairs = [(lsm_sys, conn)
+                              for conn, lsm_syss in zip(self.conns, sys_lists)
+                              for lsm_sys in lsm_syss]
+            self.syss = [lsm_sys for lsm_sys, _ in sys_conn_pairs]
+            self.sys_con_map = {
+                lsm_sys.id: conn
+                for lsm_sys, conn in sys_conn_pairs
+            }
+            if not self.sys_con_map:
+                raise LsmError(ErrorNumber.NO_SUPPORT,
+                               "No supported systems found")
+        except Exception as register_error:
+            # Stop the sub-plugins and pool threads now instead of keeping
+            # them until the plugin is discarded.
+            try:
+                self.plugin_unregister()
+            except LsmError:
+                pass
+            raise register_error
 
     @_handle_errors
     def plugin_unregister(self, flags=Client.FLAG_RSVD):
-        for conn in self.conns:
-            conn.plugin_unregister()
-        self.unregistered = True
+        def _unregister(conn):
+            try:
+                conn.plugin_unregister()
+            except Exception as unreg_error:
+                return unreg_error
+            return None
+
+        # Unregister all sub-plugins even if some fail, so that no sub-plugin
+        # process is left behind, then report the first failure.
+        unreg_errors = []
+        if self._pool is not None:
+            unreg_errors = [
+                e for e in self._pool.map(_unregister, self.conns)
+                if e is not None
+            ]
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._cap_cache.clear()
+        self._query_cache.clear()
+        self._method_cache.clear()
+        if self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
+        self.conns = []
+        self.syss = []
+        self.sys_con_map = {}
+        self.nfs_conn = None
+        if unreg_errors:
+            raise unreg_errors[0]
 
     @_handle_errors
     def job_status(self, job_id, flags=Client.FLAG_RSVD):
@@ -194,10 +328,16 @@ def time_out_get(self, flags=Client.FLAG_RSVD):
 
     @_handle_errors
     def capabilities(self, system, flags=Client.FLAG_RSVD):
-        return self._exec(system.id, "capabilities", {
+        # Capabilities of a system never change during the connection.
+        cap = self._cap_cache.get(system.id)
+        if cap is not None:
+            return cap
+        cap = self._exec(system.id, "capabilities", {
             "system": system,
             "flags": flags
         })
+        self._cap_cache[system.id] = cap
+        return cap
 
     @_handle_errors
     def systems(self, flags=Client.FLAG_RSVD):
@@ -261,7 +401,7 @@ def volume_raid_create(self,
                            flags=Client.FLAG_RSVD):
         if not disks:
             raise LsmError(ErrorNumber.INVALID_ARGUMENT, "No disk defined")
-        return self._exec(
+        return self._exec_modify(
             disks[0].system_id, "volume_raid_create", {
                 "name": name,
                 "raid_type": raid_type,
@@ -282,40 +422,40 @@ def volume_physical_disk_cache_update(self,
                                           volume,
                                           pdc,
                                           flags=Client.FLAG_RSVD):
-        return self._exec(volume.system_id,
-                          "volume_physical_disk_cache_update", {
-                              "volume": volume,
-                              "pdc": pdc,
-                              "flags": flags
-                          })
+        return self._exec_modify(volume.system_id,
+                                 "volume_physical_disk_cache_update", {
+                                     "volume": volume,
+                                     "pdc": pdc,
+                                     "flags": flags
+                                 })
 
     @_handle_errors
     def volume_write_cache_policy_update(self,
                                          volume,
                                          wcp,
                                          flags=Client.FLAG_RSVD):
-        return self._exec(volume.system_id, "volume_write_cache_policy_update",
-                          {
-                              "volume": volume,
-                              "wcp": wcp,
-                              "flags": flags
-                          })
+        return self._exec_modify(volume.system_id,
+                                 "volume_write_cache_policy_update", {
+                                     "volume": volume,
+                                     "wcp": wcp,
+                                     "flags": flags
+                                 })
 
     @_handle_errors
     def volume_read_cache_policy_update(self,
                                         volume,
                                         rcp,
                                         flags=Client.FLAG_RSVD):
-        return self._exec(volume.system_id, "volume_read_cache_policy_update",
-                          {
-                              "volume": volume,
-                              "rcp": rcp,
-                              "flags": flags
-                          })
+        return self._exec_modify(volume.system_id,
+                                 "volume_read_cache_policy_update", {
+                                     "volume": volume,
+                                     "rcp": rcp,
+                                     "flags": flags
+                                 })
 
     @_handle_errors
     def volume_delete(self, volume, flags=Client.FLAG_RSVD):
-        return self._exec(volume.system_id, "volume_delete", {
+        return self._exec_modify(volume.system_id, "volume_delete", {
             "volume": volume,
             "flags": flags
         })
@@ -329,12 +469,7 @@ def exports(self,
                 search_key=None,
                 search_value=None,
                 flags=Client.FLAG_RSVD):
-        if self.nfs_conn is not None:
-            return self.nfs_conn.exports(search_key, search_value, flags)
-        raise LsmError(
-            ErrorNumber.NO_SUPPORT,
-            "NFS plugin is not loaded, please start nfsd kernel "
-            "module and related services")
+        return self._nfs("exports", search_key, search_value, flags)
 
     @_handle_errors
     def export_fs(self,
@@ -348,28 +483,14 @@ def export_fs(self,
                   auth_type=None,
                   options=None,
                   flags=Client.FLAG_RSVD):
-        if self.nfs_conn is not None:
-            return self.nfs_conn.export_fs(fs_id, export_path, root_list,
-                                           rw_list, ro_list, anon_uid,
-                                           anon_gid, auth_type, options, flags)
-        raise LsmError(
-            ErrorNumber.NO_SUPPORT,
-            "NFS plugin is not loaded, please load nfsd kernel "
-            "module and related services")
+        return self._nfs("export_fs", fs_id, export_path, root_list, rw_list,
+                         ro_list, anon_uid, anon_gid, auth_type, options,
+                         flags)
 
     @_handle_errors
     def export_remove(self, export, flags=Client.FLAG_RSVD):
-        if self.nfs_conn is not None:
-            return self.nfs_conn.export_remove(export, flags)
-        raise LsmError(
-            ErrorNumber.NO_SUPPORT,
-            "NFS plugin is not loaded, please load nfsd kernel "
-            "module and related services")
+        return self._nfs("export_remove", export, flags)
 
+    @_handle_errors
     def export_auth(self, flags=Client.FLAG_RSVD):
-        if self.nfs_conn is not None:
-            return self.nfs_conn.export_auth(flags=flags)
-        raise LsmError(
-            ErrorNumber.NO_SUPPORT,
-            "NFS plugin is not loaded, please load nfsd kernel "
-            "module and related services")
+        return self._nfs("export_auth", flags=flags)